@@ -348,27 +348,60 @@ function centerScene() {
     console.log('Scene centered at origin');
 }
 
-async function loadVertebra(name, info) {
-    try {
+async function fetchArrayBuffer(url) {
+    const response = await fetch(url);
+    if (!response.ok) throw new Error(`Failed to load ${url}`);
+    return await response.arrayBuffer();
+}
+
+async function loadMeshGeometry(info) {
+    const geometry = new THREE.BufferGeometry();
+
+    if (info.verts_file) {
+        // Binary side-car format: little-endian verts + uint32 faces.
+        // Typed array construction from the fetched buffer is zero-copy.
+        const [vertsBuffer, facesBuffer] = await Promise.all([
+            fetchArrayBuffer(info.verts_file),
+            fetchArrayBuffer(info.faces_file)
+        ]);
+        let vertices;
+        if (info.quant_step) {
+            // int16 coords quantized to quant_step units relative to the crop
+            // origin: dequantize with pos = q * quant_step + origin
+            const quantized = new Int16Array(vertsBuffer);
+            const step = info.quant_step;
+            const origin = info.origin;
+            vertices = new Float32Array(quantized.length);
+            for (let i = 0; i < quantized.length; i += 3) {
+                vertices[i] = quantized[i] * step[0] + origin[0];
+                vertices[i + 1] = quantized[i + 1] * step[1] + origin[1];
+                vertices[i + 2] = quantized[i + 2] * step[2] + origin[2];
+            }
+        } else {
+            // Unquantized float32 coords
+            vertices = new Float32Array(vertsBuffer);
+        }
+        geometry.setAttribute('position', new THREE.BufferAttribute(vertices, 3));
+        geometry.setIndex(new THREE.BufferAttribute(new Uint32Array(facesBuffer), 1));
+    } else {
+        // Legacy JSON format
         const response = await fetch(info.file);
-        if (!response.ok) throw new Error(`Failed to load ${name}`);
-        
+        if (!response.ok) throw new Error(`Failed to load ${info.file}`);
         const meshData = await response.json();
-        
-        // Create Three.js geometry
-        const geometry = new THREE.BufferGeometry();
-        
-        // Add vertices
-        const vertices = new Float32Array(meshData.vertices.flat());
-        geometry.setAttribute('position', new THREE.BufferAttribute(vertices, 3));
-        
-        // Add faces (indices)
-        const indices = new Uint32Array(meshData.faces.flat());
-        geometry.setIndex(new THREE.BufferAttribute(indices, 1));
-        
-        // Compute normals for smooth shading
-        geometry.computeVertexNormals();
-        
+        geometry.setAttribute('position', new THREE.BufferAttribute(new Float32Array(meshData.vertices.flat()), 3));
+        geometry.setIndex(new THREE.BufferAttribute(new Uint32Array(meshData.faces.flat()), 1));
+    }
+
+    // Compute normals for smooth shading
+    geometry.computeVertexNormals();
+
+    return geometry;
+}
+
+async function loadVertebra(name, info) {
+    try {
+        const geometry = await loadMeshGeometry(info);
+
         // Create material with PyVista-like appearance
         const color = new THREE.Color(info.color);
         const material = new THREE.MeshPhongMaterial({
@@ -401,27 +434,19 @@ async function loadDifferenceMeshes(name, info) {
         
         // Load removed parts (red - False Positives)
         if (meshes.removed) {
-            const response = await fetch(meshes.removed.file);
-            if (response.ok) {
-                const meshData = await response.json();
-                const mesh = createMeshFromData(meshData, meshes.removed.color, `${name}_removed`);
-                if (mesh) {
-                    loadedMeshes.push(mesh);
-                    scene.add(mesh);
-                }
+            const mesh = await createDifferenceMesh(meshes.removed, `${name}_removed`);
+            if (mesh) {
+                loadedMeshes.push(mesh);
+                scene.add(mesh);
             }
         }
-        
+
         // Load added parts (blue - False Negatives)
         if (meshes.added) {
-            const response = await fetch(meshes.added.file);
-            if (response.ok) {
-                const meshData = await response.json();
-                const mesh = createMeshFromData(meshData, meshes.added.color, `${name}_added`);
-                if (mesh) {
-                    loadedMeshes.push(mesh);
-                    scene.add(mesh);
-                }
+            const mesh = await createDifferenceMesh(meshes.added, `${name}_added`);
+            if (mesh) {
+                loadedMeshes.push(mesh);
+                scene.add(mesh);
             }
         }
         
@@ -435,22 +460,11 @@ async function loadDifferenceMeshes(name, info) {
     }
 }
 
-function createMeshFromData(meshData, color, name) {
+async function createDifferenceMesh(info, name) {
     try {
-        // Create Three.js geometry
-        const geometry = new THREE.BufferGeometry();
-        
-        // Add vertices
-        const vertices = new Float32Array(meshData.vertices.flat());
-        geometry.setAttribute('position', new THREE.BufferAttribute(vertices, 3));
-        
-        // Add faces (indices)
-        const indices = new Uint32Array(meshData.faces.flat());
-        geometry.setIndex(new THREE.BufferAttribute(indices, 1));
-        
-        // Compute normals for smooth shading
-        geometry.computeVertexNormals();
-        
+        const geometry = await loadMeshGeometry(info);
+        const color = info.color;
+
         // Create material
         const material = new THREE.MeshPhongMaterial({
             color: new THREE.Color(color),
@@ -4,12 +4,45 @@ Uses proper physical spacing to ensure meshes overlay correctly
 """
 import os
 import json
+import shutil
 import numpy as np
 import nibabel as nib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from scipy.ndimage import find_objects
 from skimage import measure
 from pathlib import Path
 import time
 
+# Numba fuses the label equality test and voxel count over a crop into one
+# compiled pass; without it the mask build and sum are separate NumPy scans
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+if HAVE_NUMBA:
+    @njit(cache=True)
+    def _mask_and_count(sub, label_value):
+        mask = np.empty(sub.shape, np.uint8)
+        count = 0
+        for z in range(sub.shape[0]):
+            for y in range(sub.shape[1]):
+                for x in range(sub.shape[2]):
+                    hit = np.uint8(1) if sub[z, y, x] == label_value else np.uint8(0)
+                    mask[z, y, x] = hit
+                    count += hit
+        return mask, count
+
+
+def _extract_label(labels, bbox, label_value):
+    """Cropped uint8 mask plus voxel count for one label in a single pass"""
+    sub = labels[bbox]
+    if HAVE_NUMBA:
+        return _mask_and_count(sub, label_value)
+    mask = (sub == label_value).astype(np.uint8)
+    return mask, int(mask.sum())
+
 # Vertebrae color mapping
 VERTEBRAE_COLORS = {
     1: '#FF0000', 2: '#FF4500', 3: '#FF8C00', 4: '#FFD700', 5: '#ADFF2F', 6: '#00FF00', 7: '#00CED1',
@@ -31,135 +64,362 @@ DIFFERENCE_COLORS = {
 }
 
 
-def create_mesh_from_mask(mask, spacing, step_size=1):
-    """Create mesh with proper physical spacing"""
-    if mask.sum() == 0:
-        return None, None
-    
+def _padded_bbox(bbox, shape, pad=1):
+    """Pad a find_objects bounding box by `pad` voxels, clamped to the volume"""
+    return tuple(
+        slice(max(s.start - pad, 0), min(s.stop + pad, dim))
+        for s, dim in zip(bbox, shape)
+    )
+
+
+def _bbox_for(bboxes, label_value):
+    """Bounding box for one label from a find_objects result (None if absent)"""
+    if label_value <= len(bboxes):
+        return bboxes[label_value - 1]
+    return None
+
+
+def _union_bbox(a, b):
+    """Union of two find_objects bounding boxes (either may be None)"""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return tuple(
+        slice(min(sa.start, sb.start), max(sa.stop, sb.stop))
+        for sa, sb in zip(a, b)
+    )
+
+
+# orjson serializes ndarrays directly (no .tolist() detour) and is much
+# faster than the stdlib encoder; fall back to json when not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _dump_json(obj, path):
+    """Write a JSON file via orjson when available, pretty-printed"""
+    if orjson is not None:
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_INDENT_2))
+    else:
+        with open(path, 'w') as f:
+            json.dump(obj, f, indent=2)
+
+
+# meshoptimizer adds quadric simplification plus GPU-cache-friendly vertex
+# and index reordering; the stage is skipped when it is not installed
+try:
+    import meshoptimizer as meshopt
+except ImportError:
+    meshopt = None
+
+# Vertex quantization steps per voxel (1/16 voxel positional precision)
+QUANT_SCALE = 16
+
+# Fraction of marching-cubes indices kept by meshoptimizer simplification
+SIMPLIFY_RATIO = 0.4
+
+# Difference blobs below this voxel count are invisible at viewer scale and
+# not worth a marching-cubes run or two side-car files
+MIN_DIFF_VOXELS = 10
+
+
+def _optimize_mesh(verts, faces):
+    """Simplify and reorder a mesh with meshoptimizer when available
+
+    Simplification drops ~60% of the marching-cubes triangles within a small
+    error bound; the cache/fetch passes reorder indices and vertices so the
+    browser GPU reuses transformed vertices instead of thrashing. The
+    meshoptimizer bindings mirror the C API: each stage fills a
+    caller-allocated destination buffer and returns the used count.
+    """
+    if meshopt is None:
+        return verts, faces
+
+    verts = np.ascontiguousarray(verts, dtype=np.float32)
+    indices = np.ascontiguousarray(faces, dtype=np.uint32).ravel()
+
+    target = int(indices.size * SIMPLIFY_RATIO) // 3 * 3
+    simplified = np.empty(indices.size, dtype=np.uint32)
+    n_idx = meshopt.simplify(simplified, indices, verts,
+                             target_index_count=target, target_error=0.01)
+    indices = simplified[:n_idx]
+
+    # Drop the vertices simplification orphaned and re-index against the
+    # compacted vertex buffer
+    remap = np.empty(len(verts), dtype=np.uint32)
+    n_verts = meshopt.generate_vertex_remap(remap, indices, vertices=verts)
+    remapped_verts = np.empty((n_verts, 3), dtype=np.float32)
+    meshopt.remap_vertex_buffer(remapped_verts, verts, remap=remap)
+    remapped_indices = np.empty(n_idx, dtype=np.uint32)
+    meshopt.remap_index_buffer(remapped_indices, indices, remap=remap)
+
+    # Reorder triangles for vertex-cache reuse, then vertices for linear
+    # fetch order
+    cache_indices = np.empty(n_idx, dtype=np.uint32)
+    meshopt.optimize_vertex_cache(cache_indices, remapped_indices,
+                                  vertex_count=n_verts)
+    final_verts = np.empty_like(remapped_verts)
+    n_final = meshopt.optimize_vertex_fetch(final_verts, cache_indices,
+                                            remapped_verts)
+    return final_verts[:n_final], cache_indices.reshape(-1, 3)
+
+
+def _load_labels(path):
+    """Load a NIfTI label volume as uint8 without the float64 get_fdata() copy"""
+    img = nib.load(path)
+    labels = np.asanyarray(img.dataobj).astype(np.uint8, copy=False)
+    return img, labels
+
+
+# Minimum z-extent per slab before the parallel marching-cubes path kicks in
+_MIN_SLAB_DEPTH = 32
+
+
+def _marching_cubes_slab(mask, spacing, step_size, z0, z1):
+    """Run marching cubes on one z-slab (cube layers z0..z1-1)"""
     try:
-        # CRITICAL: Use spacing to convert voxel coords to physical coords
-        verts, faces, normals, values = measure.marching_cubes(
-            mask,
+        verts, faces, _, _ = measure.marching_cubes(
+            mask[z0:z1 + 1],
             level=0.5,
-            spacing=spacing,  # Physical spacing in mm
+            spacing=spacing,
             step_size=step_size
         )
+    except (ValueError, RuntimeError):
+        # Slab contains no surface
+        return np.empty((0, 3)), np.empty((0, 3), dtype=np.int64)
+
+    verts[:, 0] += z0 * spacing[0]
+    return verts, faces
+
+
+def _marching_cubes_parallel(mask, spacing, step_size=1):
+    """Mesh overlapping z-slabs in parallel and stitch the results
+
+    Slabs share one voxel layer so no cube is skipped; the duplicated
+    boundary vertices are merged later by the quantize+unique pass in
+    _write_mesh_binary.
+    """
+    n_chunks = min(os.cpu_count() or 1, mask.shape[0] // _MIN_SLAB_DEPTH)
+    bounds = np.linspace(0, mask.shape[0] - 1, n_chunks + 1).astype(int)
+
+    with ThreadPoolExecutor(max_workers=n_chunks) as pool:
+        parts = list(pool.map(
+            lambda span: _marching_cubes_slab(mask, spacing, step_size, span[0], span[1]),
+            zip(bounds[:-1], bounds[1:])))
+
+    all_verts = []
+    all_faces = []
+    offset = 0
+    for verts, faces in parts:
+        all_verts.append(verts)
+        all_faces.append(faces + offset)
+        offset += len(verts)
+    return np.concatenate(all_verts), np.concatenate(all_faces)
+
+
+def create_mesh_from_mask(mask, spacing, step_size=1):
+    """Create mesh with proper physical spacing (coords local to the crop)"""
+    if mask.sum() == 0:
+        return None, None
+
+    try:
+        if mask.shape[0] >= 2 * _MIN_SLAB_DEPTH and (os.cpu_count() or 1) > 1:
+            # Large crop: split into z-slabs and mesh them in parallel
+            verts, faces = _marching_cubes_parallel(mask, spacing, step_size)
+        else:
+            # CRITICAL: Use spacing to convert voxel coords to physical coords
+            verts, faces, normals, values = measure.marching_cubes(
+                mask,
+                level=0.5,
+                spacing=spacing,  # Physical spacing in mm
+                step_size=step_size
+            )
         return verts, faces
     except Exception as e:
         print(f"  ⚠️ Marching cubes failed: {e}")
         return None, None
 
 
-def export_raw_meshes(patient_id):
+def _write_mesh_binary(verts, faces, origin, spacing, output_dir, web_dir, stem):
+    """Quantize, deduplicate and write verts/faces as binary side-car files
+
+    Vertices are stored as int16 multiples of spacing/QUANT_SCALE relative
+    to the crop origin (invisible error at voxel scale); coincident vertices
+    collapse to a single entry and faces are re-indexed accordingly. The
+    viewer dequantizes with pos = q * quant_step + origin.
+    """
+    verts, faces = _optimize_mesh(verts, faces)
+
+    quant_step = np.asarray(spacing, dtype=np.float64) / QUANT_SCALE
+    quantized = np.round(verts / quant_step).astype(np.int16)
+    unique_verts, remap = np.unique(quantized, axis=0, return_inverse=True)
+    faces = remap[faces]
+
+    unique_verts.astype('<i2').tofile(f"{output_dir}/{stem}.verts.bin")
+    faces.astype('<u4').tofile(f"{output_dir}/{stem}.faces.bin")
+    return {
+        'verts_file': f"{web_dir}/{stem}.verts.bin",
+        'n_verts': len(unique_verts),
+        'faces_file': f"{web_dir}/{stem}.faces.bin",
+        'n_faces': len(faces),
+        'quant_step': [float(q) for q in quant_step],
+        'origin': [float(o) for o in origin]
+    }
+
+
+def _export_label_mesh(label_value, mask, origin, spacing, output_dir, web_dir):
+    """Mesh one cropped label mask and write its binary files (runs in a worker)"""
+    name = VERTEBRAE_NAMES.get(int(label_value), f"Label_{int(label_value)}")
+    verts, faces = create_mesh_from_mask(mask, spacing)
+
+    if verts is None:
+        return name, None
+
+    info = {
+        'label': int(label_value),
+        'color': VERTEBRAE_COLORS.get(int(label_value), '#CCCCCC'),
+    }
+    info.update(_write_mesh_binary(verts, faces, origin, spacing, output_dir, web_dir, name))
+    return name, info
+
+
+def _export_difference_mesh(mask, kind, name, origin, spacing, output_dir, web_dir, voxels):
+    """Mesh one removed/added difference mask and write its binary files (runs in a worker)"""
+    verts, faces = create_mesh_from_mask(mask, spacing)
+
+    if verts is None:
+        return name, kind, None
+
+    info = {
+        'color': DIFFERENCE_COLORS[kind],
+        'voxels': voxels
+    }
+    info.update(_write_mesh_binary(verts, faces, origin, spacing, output_dir, web_dir, f"{name}_{kind}"))
+    return name, kind, info
+
+
+def _reuse_reference_mesh(name, ref_info, output_dir, web_dir):
+    """Copy an already-exported mesh's side-car files instead of re-meshing"""
+    info = dict(ref_info)
+    for key in ('verts_file', 'faces_file'):
+        # Exported web paths are also the on-disk paths relative to the root
+        src = info[key]
+        basename = os.path.basename(src)
+        shutil.copyfile(src, f"{output_dir}/{basename}")
+        info[key] = f"{web_dir}/{basename}"
+    return info
+
+
+def _export_label_meshes(labels, spacing, output_dir, web_dir,
+                         ref_labels=None, ref_vertebrae=None):
+    """Mesh all labels in parallel (each vertebra is an independent job)
+
+    When a reference export is given (ref_labels plus its metadata), labels
+    whose masks are untouched by post-processing reuse the reference mesh
+    files instead of running marching cubes again.
+    """
+    unique_labels = sorted(set(np.unique(labels)) - {0})
+    label_bboxes = find_objects(labels)
+    ref_bboxes = find_objects(ref_labels) if ref_labels is not None else None
+
+    vertebrae = {}
+    n_workers = min(len(unique_labels), os.cpu_count()) or 1
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = []
+        for label_value in unique_labels:
+            name = VERTEBRAE_NAMES.get(int(label_value), f"Label_{int(label_value)}")
+
+            # Crop to the label's bounding box (1-voxel pad) so marching cubes
+            # only touches the vertebra, not the whole volume; with a
+            # reference, widen to the union so mask equality is conclusive
+            bbox = _bbox_for(label_bboxes, int(label_value))
+            if ref_bboxes is not None:
+                bbox = _union_bbox(bbox, _bbox_for(ref_bboxes, int(label_value)))
+            bbox = _padded_bbox(bbox, labels.shape)
+
+            mask, voxels = _extract_label(labels, bbox, int(label_value))
+            if voxels == 0:
+                continue
+
+            if ref_vertebrae is not None and name in ref_vertebrae:
+                ref_mask, ref_voxels = _extract_label(ref_labels, bbox, int(label_value))
+                if ref_voxels == voxels and np.array_equal(mask, ref_mask):
+                    vertebrae[name] = _reuse_reference_mesh(
+                        name, ref_vertebrae[name], output_dir, web_dir)
+                    print(f"  {name} ✓ (unchanged, reusing raw mesh)")
+                    continue
+
+            origin = tuple(s.start * sp for s, sp in zip(bbox, spacing))
+            futures.append(executor.submit(
+                _export_label_mesh, label_value, mask, origin, spacing, output_dir, web_dir))
+
+        for future in futures:
+            name, info = future.result()
+            if info is not None:
+                vertebrae[name] = info
+                print(f"  {name} ✓ ({info['n_verts']:,} vertices)")
+            else:
+                print(f"  {name} ❌ Failed")
+
+    return vertebrae
+
+
+def export_raw_meshes(patient_id, labels, spacing):
     """Export raw prediction meshes"""
     print(f"\n{'='*70}")
     print(f"📦 Exporting RAW meshes: {patient_id}")
     print(f"{'='*70}")
-    
-    nii_path = f"{patient_id}/combined_labels.nii.gz"
-    nii = nib.load(nii_path)
-    labels = nii.get_fdata().astype(np.uint8)
-    spacing = tuple(float(x) for x in nii.header.get_zooms())
-    
+
     print(f"Shape: {labels.shape}, Spacing: {spacing}")
-    
+
     output_dir = f"web_data/{patient_id}"
     os.makedirs(output_dir, exist_ok=True)
     
-    metadata = {'vertebrae': {}}
-    unique_labels = sorted(set(np.unique(labels)) - {0})
-    
-    for label_value in unique_labels:
-        name = VERTEBRAE_NAMES.get(int(label_value), f"Label_{int(label_value)}")
-        print(f"  {name}...", end=' ', flush=True)
-        
-        mask = (labels == label_value).astype(np.uint8)
-        verts, faces = create_mesh_from_mask(mask, spacing)
-        
-        if verts is not None:
-            mesh_file = f"{output_dir}/{name}.json"
-            with open(mesh_file, 'w') as f:
-                json.dump({'vertices': verts.tolist(), 'faces': faces.tolist()}, f)
-            
-            metadata['vertebrae'][name] = {
-                'label': int(label_value),
-                'color': VERTEBRAE_COLORS.get(int(label_value), '#CCCCCC'),
-                'file': f"web_data/{patient_id}/{name}.json",
-                'vertices': len(verts)
-            }
-            print(f"✓ ({len(verts):,} vertices)")
-        else:
-            print(f"❌ Failed")
-    
-    with open(f"{output_dir}/metadata.json", 'w') as f:
-        json.dump(metadata, f, indent=2)
+    metadata = {'vertebrae': _export_label_meshes(
+        labels, spacing, output_dir, f"web_data/{patient_id}")}
+
+    _dump_json(metadata, f"{output_dir}/metadata.json")
     
     print(f"✓ Raw meshes exported: {len(metadata['vertebrae'])} vertebrae\n")
     return metadata
 
 
-def export_cleaned_meshes(patient_id):
-    """Export cleaned (post-processed) prediction meshes"""
+def export_cleaned_meshes(patient_id, labels, spacing, raw_labels=None, raw_metadata=None):
+    """Export cleaned (post-processed) prediction meshes
+
+    Passing the raw labels and their export metadata lets vertebrae that the
+    post-processing left untouched reuse the raw mesh files verbatim.
+    """
     print(f"\n{'='*70}")
     print(f"🧹 Exporting CLEANED meshes: {patient_id}")
     print(f"{'='*70}")
-    
-    nii_path = f"{patient_id}/combined_labels_CLEANED.nii.gz"
-    nii = nib.load(nii_path)
-    labels = nii.get_fdata().astype(np.uint8)
-    spacing = tuple(float(x) for x in nii.header.get_zooms())
-    
+
     print(f"Shape: {labels.shape}, Spacing: {spacing}")
-    
+
     output_dir = f"web_data/{patient_id}_cleaned"
     os.makedirs(output_dir, exist_ok=True)
     
-    metadata = {'vertebrae': {}}
-    unique_labels = sorted(set(np.unique(labels)) - {0})
-    
-    for label_value in unique_labels:
-        name = VERTEBRAE_NAMES.get(int(label_value), f"Label_{int(label_value)}")
-        print(f"  {name}...", end=' ', flush=True)
-        
-        mask = (labels == label_value).astype(np.uint8)
-        verts, faces = create_mesh_from_mask(mask, spacing)
-        
-        if verts is not None:
-            mesh_file = f"{output_dir}/{name}.json"
-            with open(mesh_file, 'w') as f:
-                json.dump({'vertices': verts.tolist(), 'faces': faces.tolist()}, f)
-            
-            metadata['vertebrae'][name] = {
-                'label': int(label_value),
-                'color': VERTEBRAE_COLORS.get(int(label_value), '#CCCCCC'),
-                'file': f"web_data/{patient_id}_cleaned/{name}.json",
-                'vertices': len(verts)
-            }
-            print(f"✓ ({len(verts):,} vertices)")
-        else:
-            print(f"❌ Failed")
-    
-    with open(f"{output_dir}/metadata.json", 'w') as f:
-        json.dump(metadata, f, indent=2)
+    ref_vertebrae = raw_metadata['vertebrae'] if raw_metadata else None
+    metadata = {'vertebrae': _export_label_meshes(
+        labels, spacing, output_dir, f"web_data/{patient_id}_cleaned",
+        ref_labels=raw_labels, ref_vertebrae=ref_vertebrae)}
+
+    _dump_json(metadata, f"{output_dir}/metadata.json")
     
     print(f"✓ Cleaned meshes exported: {len(metadata['vertebrae'])} vertebrae\n")
     return metadata
 
 
-def export_difference_meshes(patient_id):
+def export_difference_meshes(patient_id, raw_data, cleaned_data, spacing):
     """Export difference meshes (removed/added parts)"""
     print(f"\n{'='*70}")
     print(f"🔀 Exporting DIFFERENCE meshes: {patient_id}")
     print(f"{'='*70}")
-    
-    # Load both raw and cleaned
-    raw_img = nib.load(f"{patient_id}/combined_labels.nii.gz")
-    cleaned_img = nib.load(f"{patient_id}/combined_labels_CLEANED.nii.gz")
-    
-    raw_data = raw_img.get_fdata()
-    cleaned_data = cleaned_img.get_fdata()
-    spacing = tuple(float(x) for x in raw_img.header.get_zooms())
-    
+
     print(f"Shape: {raw_data.shape}, Spacing: {spacing}")
     
     output_dir = f"web_data/{patient_id}_difference"
@@ -175,74 +435,84 @@ def export_difference_meshes(patient_id):
         'vertebrae': {}
     }
     
-    unique_labels = sorted(set(np.unique(cleaned_data)) - {0})
-    
+    # One 25x25 confusion matrix gives every (raw, cleaned) voxel pair count
+    # in a single O(N) pass instead of four full-volume scans per label
+    counts = np.bincount(
+        (raw_data.astype(np.uint16) * 25 + cleaned_data).ravel(),
+        minlength=25 * 25).reshape(25, 25)
+
+    raw_bboxes = find_objects(raw_data)
+    cleaned_bboxes = find_objects(cleaned_data)
+
+    unique_labels = [lv for lv in range(1, 25) if counts[:, lv].sum() > 0]
+    web_dir = f"web_data/{patient_id}_difference"
+
     total_removed = 0
     total_added = 0
-    
-    for label_num in unique_labels:
-        name = VERTEBRAE_NAMES.get(int(label_num), f"Label_{int(label_num)}")
-        print(f"  {name}...", end=' ', flush=True)
-        
-        raw_mask = (raw_data == label_num).astype(np.uint8)
-        cleaned_mask = (cleaned_data == label_num).astype(np.uint8)
-        
-        removed_mask = (raw_mask == 1) & (cleaned_mask == 0)
-        added_mask = (cleaned_mask == 1) & (raw_mask == 0)
-        
-        removed_voxels = int(removed_mask.sum())
-        added_voxels = int(added_mask.sum())
-        
-        total_removed += removed_voxels
-        total_added += added_voxels
-        
-        vertebra_info = {
-            'name': name,
-            'label': int(label_num),
-            'raw_voxels': int(raw_mask.sum()),
-            'cleaned_voxels': int(cleaned_mask.sum()),
-            'removed_voxels': removed_voxels,
-            'added_voxels': added_voxels,
-            'meshes': {}
-        }
-        
-        # Export removed mesh
-        if removed_voxels > 0:
-            verts, faces = create_mesh_from_mask(removed_mask, spacing)
-            if verts is not None:
-                mesh_file = f"{output_dir}/{name}_removed.json"
-                with open(mesh_file, 'w') as f:
-                    json.dump({'vertices': verts.tolist(), 'faces': faces.tolist(), 'color': DIFFERENCE_COLORS['removed']}, f)
-                
-                vertebra_info['meshes']['removed'] = {
-                    'file': f"web_data/{patient_id}_difference/{name}_removed.json",
-                    'color': DIFFERENCE_COLORS['removed'],
-                    'vertices': len(verts),
-                    'faces': len(faces),
-                    'voxels': removed_voxels
-                }
-        
-        # Export added mesh
-        if added_voxels > 0:
-            verts, faces = create_mesh_from_mask(added_mask, spacing)
-            if verts is not None:
-                mesh_file = f"{output_dir}/{name}_added.json"
-                with open(mesh_file, 'w') as f:
-                    json.dump({'vertices': verts.tolist(), 'faces': faces.tolist(), 'color': DIFFERENCE_COLORS['added']}, f)
-                
-                vertebra_info['meshes']['added'] = {
-                    'file': f"web_data/{patient_id}_difference/{name}_added.json",
-                    'color': DIFFERENCE_COLORS['added'],
-                    'vertices': len(verts),
-                    'faces': len(faces),
-                    'voxels': added_voxels
-                }
-        
-        metadata['vertebrae'][name] = vertebra_info
-        print(f"✓ (R:{removed_voxels}, A:{added_voxels})")
-    
-    with open(f"{output_dir}/metadata.json", 'w') as f:
-        json.dump(metadata, f, indent=2)
+
+    n_workers = min(len(unique_labels), os.cpu_count()) or 1
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = []
+        for label_num in unique_labels:
+            name = VERTEBRAE_NAMES.get(label_num, f"Label_{label_num}")
+
+            raw_voxels = int(counts[label_num, :].sum())
+            cleaned_voxels = int(counts[:, label_num].sum())
+            unchanged = int(counts[label_num, label_num])
+            removed_voxels = raw_voxels - unchanged
+            added_voxels = cleaned_voxels - unchanged
+
+            total_removed += removed_voxels
+            total_added += added_voxels
+
+            metadata['vertebrae'][name] = {
+                'name': name,
+                'label': label_num,
+                'raw_voxels': raw_voxels,
+                'cleaned_voxels': cleaned_voxels,
+                'removed_voxels': removed_voxels,
+                'added_voxels': added_voxels,
+                'meshes': {}
+            }
+            print(f"  {name}: R:{removed_voxels}, A:{added_voxels}")
+
+            if removed_voxels < MIN_DIFF_VOXELS and added_voxels < MIN_DIFF_VOXELS:
+                continue
+
+            # Only now materialize the masks, restricted to the union of the
+            # label's raw and cleaned bounding boxes, then tighten further to
+            # the bounding box of the combined difference
+            bbox = _padded_bbox(
+                _union_bbox(_bbox_for(raw_bboxes, label_num),
+                            _bbox_for(cleaned_bboxes, label_num)),
+                raw_data.shape)
+            raw_sub = raw_data[bbox]
+            cleaned_sub = cleaned_data[bbox]
+            removed_mask = (raw_sub == label_num) & (cleaned_sub != label_num)
+            added_mask = (cleaned_sub == label_num) & (raw_sub != label_num)
+
+            tight = _padded_bbox(
+                find_objects((removed_mask | added_mask).astype(np.uint8))[0],
+                removed_mask.shape)
+            origin = tuple((b.start + t.start) * sp
+                           for b, t, sp in zip(bbox, tight, spacing))
+
+            if removed_voxels >= MIN_DIFF_VOXELS:
+                futures.append(executor.submit(
+                    _export_difference_mesh, removed_mask[tight], 'removed', name,
+                    origin, spacing, output_dir, web_dir, removed_voxels))
+
+            if added_voxels >= MIN_DIFF_VOXELS:
+                futures.append(executor.submit(
+                    _export_difference_mesh, added_mask[tight], 'added', name,
+                    origin, spacing, output_dir, web_dir, added_voxels))
+
+        for future in futures:
+            name, kind, info = future.result()
+            if info is not None:
+                metadata['vertebrae'][name]['meshes'][kind] = info
+
+    _dump_json(metadata, f"{output_dir}/metadata.json")
     
     print(f"✓ Difference meshes exported")
     print(f"  Total removed: {total_removed:,} voxels")
@@ -269,9 +539,15 @@ def main():
     
     for patient_id in patients:
         try:
-            export_raw_meshes(patient_id)
-            export_cleaned_meshes(patient_id)
-            export_difference_meshes(patient_id)
+            # Load each volume once and thread the arrays through all exports
+            raw_img, raw_labels = _load_labels(f"{patient_id}/combined_labels.nii.gz")
+            _, cleaned_labels = _load_labels(f"{patient_id}/combined_labels_CLEANED.nii.gz")
+            spacing = tuple(float(x) for x in raw_img.header.get_zooms())
+
+            raw_metadata = export_raw_meshes(patient_id, raw_labels, spacing)
+            export_cleaned_meshes(patient_id, cleaned_labels, spacing,
+                                  raw_labels=raw_labels, raw_metadata=raw_metadata)
+            export_difference_meshes(patient_id, raw_labels, cleaned_labels, spacing)
         except Exception as e:
             print(f"\n❌ Error processing {patient_id}: {e}")
             import traceback
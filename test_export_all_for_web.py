@@ -0,0 +1,39 @@
+"""
+Regression checks for the meshoptimizer stage in export_all_for_web
+"""
+
+import numpy as np
+import pytest
+from skimage import measure
+
+import export_all_for_web as exp
+
+
+def _cube_mesh():
+    mask = np.zeros((12, 12, 12), np.uint8)
+    mask[2:10, 2:10, 2:10] = 1
+    verts, faces, _, _ = measure.marching_cubes(mask, level=0.5)
+    return verts, faces
+
+
+@pytest.mark.skipif(exp.meshopt is None, reason='meshoptimizer not installed')
+def test_optimize_mesh_simplifies_and_stays_valid():
+    verts, faces = _cube_mesh()
+    out_verts, out_faces = exp._optimize_mesh(verts, faces)
+
+    # Valid indexed triangles referencing the compacted vertex buffer
+    assert out_faces.ndim == 2 and out_faces.shape[1] == 3
+    assert out_faces.max() < len(out_verts)
+    assert np.array_equal(np.unique(out_faces), np.arange(len(out_verts)))
+
+    # Simplification dropped triangles without moving the surface extents
+    assert len(out_faces) < len(faces)
+    np.testing.assert_allclose(out_verts.min(axis=0), verts.min(axis=0), atol=0.5)
+    np.testing.assert_allclose(out_verts.max(axis=0), verts.max(axis=0), atol=0.5)
+
+
+def test_optimize_mesh_is_passthrough_without_meshoptimizer(monkeypatch):
+    verts, faces = _cube_mesh()
+    monkeypatch.setattr(exp, 'meshopt', None)
+    out_verts, out_faces = exp._optimize_mesh(verts, faces)
+    assert out_verts is verts and out_faces is faces
@@ -0,0 +1,66 @@
+"""
+Regression checks for the joint-histogram paths in verify_difference_data
+"""
+
+import numpy as np
+import pytest
+
+import verify_difference_data as vdd
+
+
+def _naive_counts(raw, cleaned):
+    """Reference confusion matrix from per-label equality masks"""
+    h = np.zeros((25, 25), dtype=np.int64)
+    for r in range(25):
+        for c in range(25):
+            h[r, c] = np.count_nonzero((raw == r) & (cleaned == c))
+    return h
+
+
+def test_joint_histogram_matches_naive_counts():
+    rng = np.random.default_rng(0)
+    # Labels >= 8 overflow a uint8 shift (8 << 5 == 256), so cover the
+    # full 0..24 range to catch any narrow-dtype packing regression
+    raw = rng.integers(0, 25, size=10_000, dtype=np.uint8)
+    cleaned = rng.integers(0, 25, size=10_000, dtype=np.uint8)
+
+    assert np.array_equal(vdd._joint_histogram(raw, cleaned),
+                          _naive_counts(raw, cleaned))
+
+
+def test_bincount_fallback_matches_naive_counts(monkeypatch):
+    monkeypatch.setattr(vdd, 'HAVE_NUMBA', False)
+    rng = np.random.default_rng(1)
+    raw = rng.integers(0, 25, size=10_000, dtype=np.uint8)
+    cleaned = rng.integers(0, 25, size=10_000, dtype=np.uint8)
+
+    code_buf = np.empty(raw.size, dtype=np.uint16)
+    assert np.array_equal(vdd._joint_histogram(raw, cleaned, code_buf),
+                          _naive_counts(raw, cleaned))
+
+    # Reusing the buffer with a shorter slice (the final partial tile)
+    assert np.array_equal(vdd._joint_histogram(raw[:999], cleaned[:999], code_buf),
+                          _naive_counts(raw[:999], cleaned[:999]))
+
+
+def test_labels_beyond_24_are_cropped_out():
+    rng = np.random.default_rng(2)
+    # Labels 25..31 fit the 5-bit packing and must only land in the
+    # cropped rows/columns, leaving the 0..24 counts exact
+    raw = rng.integers(0, 32, size=10_000, dtype=np.uint8)
+    cleaned = rng.integers(0, 32, size=10_000, dtype=np.uint8)
+
+    assert np.array_equal(vdd._joint_histogram(raw, cleaned),
+                          _naive_counts(raw, cleaned))
+
+
+@pytest.mark.skipif(not vdd.HAVE_NUMBA, reason='numba not installed')
+def test_tally_is_safe_for_any_uint8_label():
+    rng = np.random.default_rng(3)
+    # The numba kernel spans the full 8-bit pair space, so even wildly
+    # malformed labels must neither corrupt memory nor the 0..24 counts
+    raw = rng.integers(0, 256, size=10_000, dtype=np.uint8)
+    cleaned = rng.integers(0, 256, size=10_000, dtype=np.uint8)
+
+    assert np.array_equal(vdd._joint_histogram(raw, cleaned),
+                          _naive_counts(raw, cleaned))